@@ -4,9 +4,10 @@ import time
 import subprocess
 import logging
 import sys
-import glob
+import socket
 import datetime
-from pymongo import MongoClient
+import threading
+from pymongo import MongoClient, ReturnDocument
 
 # Настройка логирования
 logging.basicConfig(
@@ -23,6 +24,13 @@ class PostProcessor:
         self.load_config(config_path)
         self.setup_db()
 
+        # Количество параллельных задач задается для каждого хоста отдельно (config.json общий)
+        default_workers = max(1, (os.cpu_count() or 1) // 2)
+        self.workers = int(os.environ.get('POSTPROCESSOR_WORKERS') or self.settings.get('postprocess_workers') or default_workers)
+        self.job_lease_ttl = self.settings.get('job_lease_ttl', 120)
+        self.job_max_attempts = self.settings.get('job_max_attempts', 3)
+        self.worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+
     def load_config(self, path):
         try:
             with open(path, 'r', encoding='utf-8') as f:
@@ -37,34 +45,79 @@ class PostProcessor:
 
     def setup_db(self):
         try:
-            self.client = MongoClient(self.mongo_config.get('uri'), serverSelectionTimeoutMS=2000)
+            self.client = MongoClient(
+                self.mongo_config.get('uri'),
+                serverSelectionTimeoutMS=2000,
+                connectTimeoutMS=2000,
+                socketTimeoutMS=5000,
+                timeoutMS=5000
+            )
             self.db = self.client[self.mongo_config.get('db_name')]
             self.collection = self.db[self.mongo_config.get('collection')]
             self.publish_queue = self.db['publish_queue']
+            self.jobs = self.db['postprocess_jobs']
             # Проверка подключения
             self.client.server_info()
+            self.jobs.create_index('ts_file', unique=True)
+            self.jobs.create_index([('status', 1), ('created_at', 1)])
             logger.info("Успешное подключение к MongoDB")
         except Exception as e:
             logger.error(f"Ошибка подключения к MongoDB: {e}")
             self.collection = None
             self.publish_queue = None
+            self.jobs = None
+
+    def run_ffmpeg(self, cmd, lost=None):
+        """Запуск ffmpeg с прерыванием, если аренда задачи потеряна"""
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while True:
+            try:
+                process.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                if lost is not None and lost.is_set():
+                    process.kill()
+                    process.wait()
+                    raise RuntimeError("аренда задачи потеряна, обработка прервана")
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
 
-    def process_segment(self, ts_file):
+    def process_segment(self, ts_file, lost=None):
         """Обработка одного сегмента: создание версии без вотермарки и с вотермаркой"""
         try:
             mp4_file = ts_file.replace('.ts', '.mp4')
             mp4_file_orig = ts_file.replace('.ts', '_orig.mp4')
+            thumbnail_file = ts_file.replace('.ts', '_thumb.jpg')
             
-            if os.path.exists(mp4_file) and os.path.exists(mp4_file_orig):
-                return # Уже обработан
+            if not os.path.exists(ts_file):
+                if os.path.exists(mp4_file) and os.path.exists(mp4_file_orig):
+                    return True # Уже обработан
+                logger.error(f"Файл сегмента не найден: {ts_file}")
+                return False
 
             logger.info(f"Обработка сегмента: {ts_file}")
             
-            # 1. Создаем оригинальную версию (без вотермарки)
+            # 1. Создаем оригинальную версию (без вотермарки) и превью за один проход ffmpeg
             cmd_orig = ['ffmpeg', '-y', '-i', ts_file, '-c', 'copy', mp4_file_orig]
-            subprocess.run(cmd_orig, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            cmd_thumbnail = [
+                # Превью для Telegram: JPEG не больше 320x320
+                '-map', '0:v:0?', '-vf', 'thumbnail,scale=320:320:force_original_aspect_ratio=decrease',
+                '-frames:v', '1', '-q:v', '5', '-update', '1', thumbnail_file
+            ]
+            try:
+                self.run_ffmpeg(cmd_orig + cmd_thumbnail, lost)
+            except subprocess.CalledProcessError:
+                # Например, в сегменте нет видео: превью не нужно, но оригинал создать необходимо
+                logger.warning(f"Не удалось создать превью для {ts_file}, создаем только оригинал")
+                if os.path.exists(thumbnail_file):
+                    os.remove(thumbnail_file)
+                self.run_ffmpeg(cmd_orig, lost)
             logger.info(f"Оригинальный сегмент создан: {mp4_file_orig}")
 
+            media = self.probe_segment(mp4_file_orig)
+            if os.path.exists(thumbnail_file):
+                media['thumbnail'] = thumbnail_file
+
             # 2. Создаем версию с вотермаркой (используем оригинал как источник, чтобы не читать TS дважды, или TS)
             # Используем TS как источник, так надежнее
             watermark_path = self.settings.get('watermark_path')
@@ -95,22 +148,72 @@ class PostProcessor:
             
             cmd.append(mp4_file)
             
-            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            self.run_ffmpeg(cmd, lost)
             logger.info(f"Сегмент с вотермаркой создан: {mp4_file}")
             
-            # Удаляем исходный .ts файл после успешной конвертации обоих файлов
+            # Задачу уже забрал другой воркер - он и опубликует сегмент
+            if lost is not None and lost.is_set():
+                logger.warning(f"Аренда задачи потеряна, сегмент не записывается в БД: {ts_file}")
+                return False
+
+            # Обновление БД. Если не удалось, .ts остается и задача будет повторена
+            if not self.update_db(mp4_file, mp4_file_orig, media):
+                return False
+
+            # Удаляем исходный .ts файл только после успешной записи в БД:
+            # отсутствие .ts означает, что сегмент полностью обработан
             if os.path.exists(mp4_file) and os.path.exists(mp4_file_orig):
                 os.remove(ts_file)
-            
-            # Обновление БД
-            self.update_db(mp4_file, mp4_file_orig)
+            return True
             
         except Exception as e:
             logger.error(f"Ошибка обработки сегмента {ts_file}: {e}")
+            return False
 
-    def update_db(self, mp4_file, mp4_file_orig):
-        if self.collection is None:
-            return
+    def probe_segment(self, mp4_file):
+        """Размеры, длительность и индекс ключевых кадров (время и смещение в байтах) сегмента"""
+        # Отдельный проход ffprobe: без декодирования, но файл читается целиком
+        # (демультиплексируются все пакеты видеодорожки)
+        cmd = [
+            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'stream=width,height:format=duration:packet=pts_time,pos,flags',
+            '-of', 'json', mp4_file
+        ]
+        try:
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+            probe = json.loads(result.stdout)
+        except Exception as e:
+            logger.error(f"Ошибка анализа сегмента {mp4_file}: {e}")
+            return {}
+
+        media = {}
+        streams = probe.get('streams') or [{}]
+        if streams[0].get('width') and streams[0].get('height'):
+            media['width'] = streams[0]['width']
+            media['height'] = streams[0]['height']
+
+        try:
+            media['duration'] = float(probe.get('format', {}).get('duration'))
+        except (TypeError, ValueError):
+            pass
+
+        keyframes = []
+        for packet in probe.get('packets', []):
+            if not packet.get('flags', '').startswith('K'):
+                continue
+            try:
+                keyframes.append([float(packet['pts_time']), int(packet['pos'])])
+            except (KeyError, ValueError):
+                continue
+        media['keyframes'] = keyframes
+
+        return media
+
+    def update_db(self, mp4_file, mp4_file_orig, media=None):
+        """Запись сегмента в БД и очередь публикации. False - задачу нужно повторить"""
+        if self.collection is None or self.publish_queue is None:
+            logger.error(f"Нет подключения к MongoDB, сегмент не записан в БД: {mp4_file}")
+            return False
 
         try:
             # Получаем директорию файла для поиска info.json
@@ -125,7 +228,7 @@ class PostProcessor:
             stream_id = stream_info.get('id')
             if not stream_id:
                 logger.warning(f"Не найден stream_id для {mp4_file}")
-                return
+                return False
 
             # Определяем номер сегмента из имени файла (video_001.mp4 -> 1)
             filename = os.path.basename(mp4_file)
@@ -150,7 +253,7 @@ class PostProcessor:
                 {'stream_id': stream_id},
                 {
                     '$set': metadata,
-                    '$setOnInsert': {'segments': {}, 'segments_original': {}}
+                    '$setOnInsert': {'segments': {}, 'segments_original': {}, 'segments_media': {}}
                 },
                 upsert=True
             )
@@ -162,14 +265,20 @@ class PostProcessor:
                 {
                     '$set': {
                         f'segments.{segment_key}': mp4_file,
-                        f'segments_original.{segment_key}': mp4_file_orig
+                        f'segments_original.{segment_key}': mp4_file_orig,
+                        # Превью, размеры и индекс ключевых кадров (для segments_original)
+                        f'segments_media.{segment_key}': media or {}
                     }
                 }
             )
             
             logger.info(f"БД обновлена для стрима {stream_id}, сегмент {sequence_number}")
             
-            # Отправка уведомлений в очередь публикации
+            # Параметры видео для Telegram (индекс ключевых кадров в очередь не передаем)
+            publish_media = {k: v for k, v in (media or {}).items() if k != 'keyframes'}
+
+            # Отправка уведомлений в очередь публикации. Задачи вставляются через upsert,
+            # чтобы повторная обработка сегмента не создавала дубликаты публикаций
             if self.publish_queue is not None:
                 # Задача для видео с вотермаркой (основной канал)
                 queue_item_wm = {
@@ -177,11 +286,16 @@ class PostProcessor:
                     'sequence_number': sequence_number,
                     'file_path': mp4_file,
                     'info': stream_info,
+                    'media': publish_media,
                     'created_at': datetime.datetime.now(),
                     'status': 'pending',
                     'target_type': 'watermarked'
                 }
-                self.publish_queue.insert_one(queue_item_wm)
+                self.publish_queue.update_one(
+                    {'file_path': mp4_file, 'target_type': 'watermarked'},
+                    {'$setOnInsert': queue_item_wm},
+                    upsert=True
+                )
                 
                 # Задача для оригинального видео (премиум канал)
                 queue_item_orig = {
@@ -189,72 +303,134 @@ class PostProcessor:
                     'sequence_number': sequence_number,
                     'file_path': mp4_file_orig,
                     'info': stream_info,
+                    'media': publish_media,
                     'created_at': datetime.datetime.now(),
                     'status': 'pending',
                     'target_type': 'original'
                 }
-                self.publish_queue.insert_one(queue_item_orig)
+                self.publish_queue.update_one(
+                    {'file_path': mp4_file_orig, 'target_type': 'original'},
+                    {'$setOnInsert': queue_item_orig},
+                    upsert=True
+                )
                 
                 logger.info(f"Добавлено в очередь публикации: {stream_id} #{sequence_number} (2 tasks)")
 
+            return True
+
         except Exception as e:
             logger.error(f"Ошибка обновления БД: {e}")
+            return False
 
 
-    def run(self):
-        """Фоновый процесс для обработки завершенных сегментов"""
-        logger.info("Запущен процесс постобработки (watermark)...")
+    def claim_job(self, worker_id):
+        """Захват задачи из очереди: новой или с истекшей арендой (упавший воркер)"""
+        now = time.time()
+
+        # Задачи, воркеры которых падали слишком много раз, больше не выдаем
+        self.jobs.update_many(
+            {'status': 'processing', 'lease_expires_at': {'$lt': now}, 'attempts': {'$gte': self.job_max_attempts}},
+            {'$set': {'status': 'failed', 'error': 'Lease expired'}}
+        )
+
+        return self.jobs.find_one_and_update(
+            {'$or': [
+                {'status': 'pending'},
+                {'status': 'processing', 'lease_expires_at': {'$lt': now}}
+            ]},
+            {
+                '$set': {
+                    'status': 'processing',
+                    'worker': worker_id,
+                    'started_at': datetime.datetime.now(),
+                    'heartbeat_at': now,
+                    'lease_expires_at': now + self.job_lease_ttl
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('created_at', 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def heartbeat_job(self, job, worker_id, done, lost):
+        """Продление аренды задачи, пока идет обработка. При потере аренды выставляет lost"""
+        lease_expires_at = job['lease_expires_at']
+        while not done.wait(self.job_lease_ttl / 3):
+            try:
+                now = time.time()
+                result = self.jobs.update_one(
+                    {'_id': job['_id'], 'worker': worker_id, 'status': 'processing'},
+                    {'$set': {'heartbeat_at': now, 'lease_expires_at': now + self.job_lease_ttl}}
+                )
+                if result.matched_count == 0:
+                    logger.warning(f"Аренда задачи {job['ts_file']} потеряна ({worker_id})")
+                    lost.set()
+                    return
+                lease_expires_at = now + self.job_lease_ttl
+            except Exception as e:
+                logger.error(f"Ошибка продления аренды задачи {job['ts_file']}: {e}")
+                # Продлить не удается: прерываемся до того, как задачу заберет другой воркер
+                if time.time() + self.job_lease_ttl / 3 >= lease_expires_at:
+                    logger.warning(f"Аренда задачи {job['ts_file']} истекает ({worker_id})")
+                    lost.set()
+                    return
+
+    def finish_job(self, job, worker_id, success):
+        if success:
+            update = {'status': 'completed', 'completed_at': datetime.datetime.now()}
+        elif job.get('attempts', 0) >= self.job_max_attempts:
+            update = {'status': 'failed', 'error': 'Processing failed'}
+        else:
+            # Возвращаем в очередь для повторной попытки
+            update = {'status': 'pending', 'error': 'Processing failed'}
+
+        self.jobs.update_one(
+            {'_id': job['_id'], 'worker': worker_id},
+            {'$set': update, '$unset': {'lease_expires_at': ''}}
+        )
+
+    def worker_loop(self, worker_id):
+        logger.info(f"Запущен воркер постобработки {worker_id}")
         while True:
+            if self.jobs is None:
+                time.sleep(10)
+                continue
+
             try:
-                base_path = self.settings.get('output_path', '/app/recordings')
-                if sys.platform == 'win32' and base_path.startswith('/app'):
-                    base_path = 'recordings'
-                
-                if not os.path.exists(base_path):
-                    time.sleep(10)
+                job = self.claim_job(worker_id)
+                if not job:
+                    time.sleep(5) # Нет задач
                     continue
 
-                # Ищем все .ts файлы рекурсивно
-                ts_files = glob.glob(os.path.join(base_path, '**', '*.ts'), recursive=True)
-                
-                # Группируем файлы по папкам
-                files_by_dir = {}
-                for f in ts_files:
-                    d = os.path.dirname(f)
-                    if d not in files_by_dir:
-                        files_by_dir[d] = []
-                    files_by_dir[d].append(f)
-                
-                for d, files in files_by_dir.items():
-                    # Сортируем файлы по имени (video_000.ts, video_001.ts ...)
-                    files.sort()
-                    
-                    # Обрабатываем все, кроме последнего (он может еще писаться)
-                    # Если файлов > 1, то все кроме последнего точно готовы
-                    # Если файл 1, проверяем время модификации
-                    
-                    for i, f in enumerate(files):
-                        is_last = (i == len(files) - 1)
-                        
-                        should_process = False
-                        if not is_last:
-                            should_process = True
-                        else:
-                            # Проверяем, не устарел ли последний файл (может запись упала)
-                            try:
-                                mtime = os.path.getmtime(f)
-                                if time.time() - mtime > 60: # 5 минут без изменений
-                                    should_process = True
-                            except OSError:
-                                pass
-                        
-                        if should_process:
-                            self.process_segment(f)
-                            
+                logger.info(f"Задача постобработки получена ({worker_id}): {job['ts_file']} (попытка {job['attempts']})")
+
+                done = threading.Event()
+                lost = threading.Event()
+                heartbeat_thread = threading.Thread(target=self.heartbeat_job, args=(job, worker_id, done, lost), daemon=True)
+                heartbeat_thread.start()
+                try:
+                    success = self.process_segment(job['ts_file'], lost)
+                finally:
+                    done.set()
+                    heartbeat_thread.join()
+
+                self.finish_job(job, worker_id, success)
+
             except Exception as e:
-                logger.error(f"Ошибка в цикле постобработки: {e}")
-            
-            time.sleep(10) # Проверка каждые 10 секунд
+                logger.error(f"Ошибка в цикле постобработки ({worker_id}): {e}")
+                time.sleep(5)
+
+    def run(self):
+        """Воркеры постобработки, получающие задачи из очереди в MongoDB"""
+        logger.info(f"Запущен процесс постобработки (watermark), воркеров: {self.workers}")
+        for i in range(self.workers):
+            worker_thread = threading.Thread(target=self.worker_loop, args=(f"{self.worker_prefix}-{i}",), daemon=True)
+            worker_thread.start()
+
+        while True:
+            if self.jobs is None:
+                self.setup_db()
+            time.sleep(10)
 
 if __name__ == "__main__":
     processor = PostProcessor()
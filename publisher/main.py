@@ -58,7 +58,7 @@ class Publisher:
         
         return template.format_map(SafeDict(format_data))
 
-    def send_video(self, file_path, caption, target_type='watermarked'):
+    def send_video(self, file_path, caption, target_type='watermarked', media=None):
         bot_token = self.telegram_config.get('bot_token')
         api_url = self.telegram_config.get('api_url')
         
@@ -74,6 +74,8 @@ class Publisher:
 
         url = f"{api_url}/bot{bot_token}/sendVideo"
         
+        media = media or {}
+        thumbnail_file = None
         try:
             with open(file_path, 'rb') as video_file:
                 files = {'video': video_file}
@@ -83,6 +85,18 @@ class Publisher:
                     'parse_mode': 'HTML',
                     'supports_streaming': True
                 }
+
+                # Параметры видео и превью, подготовленные постпроцессором,
+                # избавляют Telegram от обработки видео на сервере
+                for key in ('duration', 'width', 'height'):
+                    if media.get(key):
+                        data[key] = int(round(media[key]))
+
+                thumbnail_path = media.get('thumbnail')
+                if thumbnail_path and os.path.exists(thumbnail_path):
+                    thumbnail_file = open(thumbnail_path, 'rb')
+                    files['thumbnail'] = thumbnail_file
+
                 response = requests.post(url, files=files, data=data)
                 
                 if response.status_code == 200:
@@ -94,6 +108,9 @@ class Publisher:
         except Exception as e:
             logger.error(f"Ошибка при отправке запроса: {e}")
             return False
+        finally:
+            if thumbnail_file:
+                thumbnail_file.close()
 
     def run(self):
         logger.info("Запущен процесс публикации...")
@@ -117,6 +134,7 @@ class Publisher:
                     info = task.get('info', {})
                     sequence_number = task.get('sequence_number')
                     target_type = task.get('target_type', 'watermarked')
+                    media = task.get('media', {})
                     
                     # Выбор шаблона
                     if target_type == 'original':
@@ -127,7 +145,7 @@ class Publisher:
                     caption = self.format_message(template, info, sequence_number)
                     
                     if os.path.exists(file_path):
-                        success = self.send_video(file_path, caption, target_type)
+                        success = self.send_video(file_path, caption, target_type, media)
                         if success:
                             self.publish_queue.update_one(
                                 {'_id': task['_id']},
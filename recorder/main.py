@@ -1,13 +1,24 @@
+import time
+PROCESS_START = time.time() # Для замера времени от запуска до первого записанного байта
+
 import json
 import os
-import time
+import importlib
 import subprocess
 import datetime
+import hashlib
 import logging
+import socket
 import sys
+import signal
 import threading
+import hmac
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
 import schedule
-import yt_dlp
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 
 # Настройка логирования
 logging.basicConfig(
@@ -19,11 +30,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# yt_dlp импортируется лениво и только с нужными экстракторами - полный набор
+# загружается лишь для платформ, которых нет в этом списке
+PLATFORM_EXTRACTORS = {
+    'youtube': ('yt_dlp.extractor.youtube', ['YoutubeIE', 'YoutubeTabIE']),
+    'twitch': ('yt_dlp.extractor.twitch', ['TwitchStreamIE', 'TwitchVodIE'])
+}
+
 class StreamRecorder:
     def __init__(self, config_path='config.json'):
         self.load_config(config_path)
         self.active_recordings = {} # Словарь для отслеживания активных процессов записи
         self.stopped_manually = set() # Множество каналов, остановленных вручную
+        self.lock = threading.RLock() # Защита active_recordings от одновременного доступа (планировщик и API)
+        self.shutdown_event = threading.Event()
+        self.control_server = None
+        self.leases = {} # Каналы, на которые у этого экземпляра есть аренда (шардинг): имя -> время истечения
+        self.check_lock = threading.Lock() # Не допускаем параллельных проверок каналов
+        self.first_byte_at = None
+        self.pending_segments = [] # Сегменты, которые не удалось поставить в очередь (нет связи с MongoDB)
+        self.setup_db()
 
     def load_config(self, path):
         with open(path, 'r', encoding='utf-8') as f:
@@ -31,8 +57,69 @@ class StreamRecorder:
         
         self.channels = self.config.get('channels', [])
         self.settings = self.config.get('settings', {})
+        self.mongo_config = self.config.get('mongodb', {})
+        self.sharding_config = self.config.get('sharding', {})
+
+        self.sharding = bool(self.sharding_config.get('enabled', False))
+        # Токен процесса отличает экземпляры с одинаковым instance_id (например, заданным вручную)
+        self.process_token = uuid.uuid4().hex
+        self.instance_id = (
+            os.environ.get('RECORDER_INSTANCE_ID')
+            or self.sharding_config.get('instance_id')
+            or f"{socket.gethostname()}-{self.process_token[:8]}"
+        )
+        self.lease_ttl = self.sharding_config.get('lease_ttl', 30)
+
+    def setup_db(self):
+        try:
+            # Без таймаута операции запрос к недоступному серверу может зависнуть надолго
+            self.client = MongoClient(
+                self.mongo_config.get('uri'),
+                serverSelectionTimeoutMS=2000,
+                connectTimeoutMS=2000,
+                socketTimeoutMS=5000,
+                timeoutMS=5000
+            )
+            self.db = self.client[self.mongo_config.get('db_name')]
+            self.channel_leases = self.db['recorder_leases']
+            self.instances = self.db['recorder_instances']
+            self.postprocess_jobs = self.db['postprocess_jobs']
+            self.postprocess_jobs.create_index('ts_file', unique=True)
+            self.recorder_state = self.db['recorder_state']
+            # Проверка подключения
+            self.client.server_info()
+            logger.info("Успешное подключение к MongoDB")
+        except Exception as e:
+            logger.error(f"Ошибка подключения к MongoDB: {e}")
+            self.channel_leases = None
+            self.instances = None
+            self.postprocess_jobs = None
+            self.recorder_state = None
+
+    def get_platform(self, channel_url, platform=None):
+        if platform:
+            return platform.lower()
+        if 'youtube.com' in channel_url or 'youtu.be' in channel_url:
+            return 'youtube'
+        if 'twitch.tv' in channel_url:
+            return 'twitch'
+        return None
+
+    def create_ydl(self, ydl_opts, platform):
+        import yt_dlp
+
+        if platform not in PLATFORM_EXTRACTORS:
+            return yt_dlp.YoutubeDL(ydl_opts)
+
+        # auto_init=False не загружает все экстракторы yt_dlp
+        ydl = yt_dlp.YoutubeDL(ydl_opts, auto_init=False)
+        module_name, class_names = PLATFORM_EXTRACTORS[platform]
+        module = importlib.import_module(module_name)
+        for class_name in class_names:
+            ydl.add_info_extractor(getattr(module, class_name)())
+        return ydl
 
-    def get_stream_info(self, channel_url):
+    def get_stream_info(self, channel_url, platform=None):
         ydl_opts = {
             'quiet': True,
             'no_warnings': True,
@@ -64,7 +151,7 @@ class StreamRecorder:
                     channel_url += '/'
                 channel_url += 'live'
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        with self.create_ydl(ydl_opts, self.get_platform(channel_url, platform)) as ydl:
             try:
                 info = ydl.extract_info(channel_url, download=False)
                 if not info:
@@ -101,7 +188,8 @@ class StreamRecorder:
         except:
             return None
 
-    def stream_writer(self, process, path_template, max_size):
+    def stream_writer(self, recording, path_template, max_size):
+        process = recording['process']
         file_index = 0
         current_file = None
         current_size = 0
@@ -112,6 +200,9 @@ class StreamRecorder:
                 if not chunk:
                     break
                 
+                if self.first_byte_at is None:
+                    self.mark_first_byte(recording)
+
                 if current_file is None:
                     filename = path_template % file_index
                     current_file = open(filename, 'wb')
@@ -120,10 +211,12 @@ class StreamRecorder:
                 
                 current_file.write(chunk)
                 current_size += len(chunk)
+                recording['bytes_written'] += len(chunk)
                 
                 if max_size and current_size >= max_size:
                     current_file.close()
                     current_file = None
+                    self.enqueue_segment(filename)
                     file_index += 1
                     
         except Exception as e:
@@ -131,212 +224,800 @@ class StreamRecorder:
         finally:
             if current_file:
                 current_file.close()
+            self.enqueue_remaining_segments(recording['path'])
 
-    def start_recording(self, channel, stream_info):
-        channel_name = channel['name']
-        
-        if channel_name in self.stopped_manually:
-            logger.info(f"Канал {channel_name} был остановлен вручную. Пропуск.")
+    def segment_watcher(self, recording, list_path):
+        """Отслеживает список сегментов ffmpeg (режим split by time) и ставит готовые сегменты в очередь"""
+        process = recording['process']
+        enqueued = set()
+
+        # Ждем появления первых данных на диске для замера времени запуска
+        while self.first_byte_at is None and process.poll() is None:
+            if self.get_dir_size(recording['path']) > 0:
+                self.mark_first_byte(recording)
+                break
+            time.sleep(0.2)
+
+        while True:
+            try:
+                process.wait(timeout=5)
+                finished = True
+            except subprocess.TimeoutExpired:
+                finished = False
+
+            # ffmpeg дописывает строку в список только после закрытия сегмента
+            try:
+                if os.path.exists(list_path):
+                    with open(list_path, 'r', encoding='utf-8') as f:
+                        for line in f:
+                            name = line.strip()
+                            if name and name not in enqueued:
+                                ts_file = os.path.join(recording['path'], os.path.basename(name))
+                                # Учитываем размер до постановки в очередь: постпроцессор удалит .ts
+                                try:
+                                    recording['bytes_written'] += os.path.getsize(ts_file)
+                                except OSError:
+                                    pass
+                                recording['completed_segments'].add(os.path.basename(name))
+                                self.enqueue_segment(ts_file)
+                                enqueued.add(name)
+            except Exception as e:
+                logger.error(f"Ошибка чтения списка сегментов {list_path}: {e}")
+
+            if finished:
+                break
+
+        self.enqueue_remaining_segments(recording['path'])
+
+    def mark_first_byte(self, recording):
+        with self.lock:
+            if self.first_byte_at is not None:
+                return
+            self.first_byte_at = time.time()
+        logger.info(f"Первый байт записан через {self.first_byte_at - PROCESS_START:.2f} с после запуска процесса ({recording['path']})")
+
+    def enqueue_segment(self, ts_file):
+        """Публикация задачи постобработки для готового сегмента"""
+        if self.postprocess_jobs is None:
+            # Переподключение выполняет check_channels, здесь (в потоке записи) не ждем
+            self.add_pending_segment(ts_file)
             return
 
-        channel_url = channel['url']
-        
-        if channel_name in self.active_recordings:
-            # Проверяем, жив ли процесс (или поток)
-            proc = self.active_recordings[channel_name]
-            is_alive = False
-            if isinstance(proc, subprocess.Popen):
-                if proc.poll() is None: is_alive = True
-            elif isinstance(proc, dict) and 'process' in proc:
-                if proc['process'].poll() is None: is_alive = True
-            
-            if is_alive:
-                logger.info(f"Запись канала {channel_name} уже идет.")
+        try:
+            result = self.postprocess_jobs.update_one(
+                {'ts_file': ts_file},
+                {'$setOnInsert': {
+                    'ts_file': ts_file,
+                    'status': 'pending',
+                    'attempts': 0,
+                    'created_at': datetime.datetime.now()
+                }},
+                upsert=True
+            )
+            if result.upserted_id is not None:
+                logger.info(f"Сегмент поставлен в очередь постобработки: {ts_file}")
+        except Exception as e:
+            logger.error(f"Ошибка постановки сегмента {ts_file} в очередь: {e}")
+            self.add_pending_segment(ts_file)
+
+    def add_pending_segment(self, ts_file):
+        with self.lock:
+            if ts_file in self.pending_segments:
                 return
-            else:
-                logger.info(f"Предыдущая запись {channel_name} завершилась. Начинаем новую.")
-                del self.active_recordings[channel_name]
+            self.pending_segments.append(ts_file)
+        logger.warning(f"Нет связи с MongoDB, сегмент будет поставлен в очередь позже: {ts_file}")
 
-        logger.info(f"Обнаружен прямой эфир на канале: {channel_name}")
+    def flush_pending_segments(self):
+        with self.lock:
+            pending = self.pending_segments
+            self.pending_segments = []
+        if pending:
+            logger.info(f"Повторная постановка в очередь отложенных сегментов: {len(pending)}")
+        for ts_file in pending:
+            self.enqueue_segment(ts_file)
 
-        # Подготовка путей
-        date_str = datetime.datetime.now().strftime('%Y-%m-%d')
-        session_time = datetime.datetime.now().strftime('%H-%M-%S')
-        
+    def enqueue_remaining_segments(self, path):
+        # После завершения ffmpeg все сегменты в папке сессии готовы
+        try:
+            for entry in sorted(os.scandir(path), key=lambda e: e.name):
+                if entry.is_file() and entry.name.endswith('.ts') and entry.stat().st_size > 0:
+                    self.enqueue_segment(entry.path)
+        except OSError as e:
+            logger.error(f"Ошибка поиска сегментов в {path}: {e}")
+
+    def enqueue_orphan_segments(self, channel_name):
+        """Сегменты, оставшиеся после аварийного завершения рекордера"""
+        channel_root = os.path.join(self.get_output_path(), channel_name)
+        if not os.path.isdir(channel_root):
+            return
+        for date_dir in os.scandir(channel_root):
+            if not date_dir.is_dir():
+                continue
+            for session_dir in os.scandir(date_dir.path):
+                if session_dir.is_dir():
+                    self.enqueue_remaining_segments(session_dir.path)
+
+    def get_output_path(self):
         base_output_path = self.settings.get('output_path', '/app/recordings')
         if sys.platform == 'win32' and base_output_path.startswith('/app'):
              base_output_path = 'recordings'
+        return base_output_path
 
-        channel_path = os.path.join(base_output_path, channel_name, date_str, session_time)
-        os.makedirs(channel_path, exist_ok=True)
-
-        # Метаданные для БД (будут использованы пост-процессором)
-        # metadata = { ... } # Перенесено в postprocessor
+    def start_recording(self, channel, stream_info):
+        channel_name = channel['name']
         
-        try:
-            info_json_path = os.path.join(channel_path, 'info.json')
-            with open(info_json_path, 'w', encoding='utf-8') as f:
-                json.dump(stream_info, f, ensure_ascii=False, indent=4, default=str)
-            logger.info(f"Info JSON сохранен в {info_json_path}")
-        except Exception as e:
-            logger.error(f"Ошибка сохранения info.json: {e}")
+        with self.lock:
+            # Проверка, завершившаяся после остановки всех записей, не должна запускать новую
+            if self.shutdown_event.is_set():
+                logger.info(f"Идет завершение работы. Запись {channel_name} не запускается.")
+                return
 
-        stream_url = stream_info.get('url')
-        
-        # Проверяем настройки сегментации
-        segment_size_str = self.settings.get('segment_size')
-        segment_size_bytes = self.parse_size(segment_size_str)
-        
-        output_filename_template = os.path.join(channel_path, f"video_%03d.ts")
+            if not self.owns_channel(channel_name):
+                logger.info(f"Канал {channel_name} обслуживается другим экземпляром. Пропуск.")
+                return
 
-        ffmpeg_cmd = ['ffmpeg', '-y', '-i', stream_url]
-        
-        http_headers = stream_info.get('http_headers', {})
-        if http_headers and 'User-Agent' in http_headers:
-            ffmpeg_cmd.insert(1, '-user_agent')
-            ffmpeg_cmd.insert(2, http_headers['User-Agent'])
-
-        if segment_size_bytes:
-            # Режим разделения по размеру
-            # ffmpeg пишет в stdout -> Python читает и пишет в файлы
-            ffmpeg_cmd.extend(['-c', 'copy', '-f', 'mpegts', '-'])
+            if channel_name in self.stopped_manually:
+                logger.info(f"Канал {channel_name} был остановлен вручную. Пропуск.")
+                return
+
+            if channel_name in self.active_recordings:
+                # Проверяем, жив ли процесс записи
+                if self.active_recordings[channel_name]['process'].poll() is None:
+                    logger.info(f"Запись канала {channel_name} уже идет.")
+                    return
+                else:
+                    logger.info(f"Предыдущая запись {channel_name} завершилась. Начинаем новую.")
+                    del self.active_recordings[channel_name]
+
+            logger.info(f"Обнаружен прямой эфир на канале: {channel_name}")
+
+            # Подготовка путей
+            date_str = datetime.datetime.now().strftime('%Y-%m-%d')
+            session_time = datetime.datetime.now().strftime('%H-%M-%S')
+            
+            channel_path = os.path.join(self.get_output_path(), channel_name, date_str, session_time)
+            os.makedirs(channel_path, exist_ok=True)
+
+            # Метаданные для БД (будут использованы пост-процессором)
+            # metadata = { ... } # Перенесено в postprocessor
             
-            logger.info(f"Запуск записи (split by size: {segment_size_str}) для {channel_name}...")
-            try:
-                p = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-                
-                # Запускаем поток записи
-                writer_thread = threading.Thread(
-                    target=self.stream_writer,
-                    args=(p, output_filename_template, segment_size_bytes),
-                    daemon=True
-                )
-                writer_thread.start()
-                
-                self.active_recordings[channel_name] = {'process': p, 'thread': writer_thread}
-                
-            except Exception as e:
-                logger.error(f"Не удалось запустить процесс записи: {e}")
-        else:
-            # Режим разделения по времени (стандартный ffmpeg segment)
-            segment_time = self.settings.get('segment_time', '00:30:00')
-            ffmpeg_cmd.extend([
-                '-c', 'copy',
-                '-f', 'segment',
-                '-segment_time', str(segment_time),
-                '-reset_timestamps', '1',
-                '-strftime', '0',
-                output_filename_template
-            ])
-
-            logger.info(f"Запуск записи (split by time) для {channel_name}...")
             try:
-                p = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                self.active_recordings[channel_name] = p 
+                info_json_path = os.path.join(channel_path, 'info.json')
+                with open(info_json_path, 'w', encoding='utf-8') as f:
+                    json.dump(stream_info, f, ensure_ascii=False, indent=4, default=str)
+                logger.info(f"Info JSON сохранен в {info_json_path}")
             except Exception as e:
-                logger.error(f"Не удалось запустить процесс записи: {e}")
+                logger.error(f"Ошибка сохранения info.json: {e}")
 
-    def stop_recording(self, channel_name):
-        if channel_name in self.active_recordings:
-            logger.info(f"Остановка записи канала: {channel_name}")
-            obj = self.active_recordings[channel_name]
+            stream_url = stream_info.get('url')
             
-            proc = None
-            if isinstance(obj, subprocess.Popen):
-                proc = obj
-            elif isinstance(obj, dict):
-                proc = obj.get('process')
+            # Проверяем настройки сегментации
+            segment_size_str = self.settings.get('segment_size')
+            segment_size_bytes = self.parse_size(segment_size_str)
             
-            if proc:
-                proc.terminate()
-                try:
-                    proc.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    proc.kill()
+            output_filename_template = os.path.join(channel_path, f"video_%03d.ts")
+
+            ffmpeg_cmd = ['ffmpeg', '-y', '-i', stream_url]
+            
+            http_headers = stream_info.get('http_headers', {})
+            if http_headers and 'User-Agent' in http_headers:
+                ffmpeg_cmd.insert(1, '-user_agent')
+                ffmpeg_cmd.insert(2, http_headers['User-Agent'])
+
+            # Состояние записи (используется API управления)
+            recording = {
+                'process': None,
+                'thread': None,
+                'mode': 'size' if segment_size_bytes else 'time',
+                'path': channel_path,
+                'stream_id': stream_info.get('id'),
+                'title': stream_info.get('title'),
+                'started_at': time.time(),
+                'bytes_written': 0,
+                'completed_segments': set() # Режим split by time: сегменты, уже учтенные в bytes_written
+            }
+
+            if segment_size_bytes:
+                # Режим разделения по размеру
+                # ffmpeg пишет в stdout -> Python читает и пишет в файлы
+                ffmpeg_cmd.extend(['-c', 'copy', '-f', 'mpegts', '-'])
                 
-            del self.active_recordings[channel_name]
-            self.stopped_manually.add(channel_name)
-            logger.info(f"Запись {channel_name} остановлена.")
-        else:
+                logger.info(f"Запуск записи (split by size: {segment_size_str}) для {channel_name}...")
+                try:
+                    recording['process'] = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                    
+                    # Запускаем поток записи
+                    writer_thread = threading.Thread(
+                        target=self.stream_writer,
+                        args=(recording, output_filename_template, segment_size_bytes),
+                        daemon=True
+                    )
+                    writer_thread.start()
+                    recording['thread'] = writer_thread
+                    
+                    self.active_recordings[channel_name] = recording
+                    
+                except Exception as e:
+                    logger.error(f"Не удалось запустить процесс записи: {e}")
+            else:
+                # Режим разделения по времени (стандартный ffmpeg segment)
+                segment_time = self.settings.get('segment_time', '00:30:00')
+                segment_list_path = os.path.join(channel_path, 'segments.txt')
+                ffmpeg_cmd.extend([
+                    '-c', 'copy',
+                    '-f', 'segment',
+                    '-segment_time', str(segment_time),
+                    '-reset_timestamps', '1',
+                    '-strftime', '0',
+                    '-segment_list', segment_list_path,
+                    '-segment_list_type', 'flat',
+                    output_filename_template
+                ])
+
+                logger.info(f"Запуск записи (split by time) для {channel_name}...")
+                try:
+                    recording['process'] = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+                    # Запускаем поток отслеживания готовых сегментов
+                    watcher_thread = threading.Thread(
+                        target=self.segment_watcher,
+                        args=(recording, segment_list_path),
+                        daemon=True
+                    )
+                    watcher_thread.start()
+                    recording['thread'] = watcher_thread
+
+                    self.active_recordings[channel_name] = recording
+                except Exception as e:
+                    logger.error(f"Не удалось запустить процесс записи: {e}")
+
+        # Состояние сохраняем вне блокировки: медленная MongoDB не должна задерживать API
+        if self.active_recordings.get(channel_name) is recording:
+            self.save_state(channel_name, stream_info)
+
+    def stop_recording(self, channel_name, manual=True):
+        with self.lock:
+            recording = self.active_recordings.pop(channel_name, None)
+            if recording is not None and manual:
+                self.stopped_manually.add(channel_name)
+
+        if recording is None:
             logger.warning(f"Канал {channel_name} сейчас не записывается.")
+            return False
 
-    def command_listener(self):
-        logger.info("Запущен слушатель команд. Доступные команды: stop <channel_name>, list, quit, resume <channel_name>")
-        while True:
+        if manual:
+            # Остановленный вручную канал не должен перезапускаться при быстром старте
+            self.clear_state(channel_name)
+
+        logger.info(f"Остановка записи канала: {channel_name}")
+        proc = recording['process']
+        
+        # SIGTERM позволяет ffmpeg корректно завершить текущий сегмент
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+        # Дожидаемся, пока поток записи сбросит остаток данных на диск и поставит сегменты в очередь
+        writer_thread = recording.get('thread')
+        if writer_thread is not None:
+            writer_thread.join(timeout=10)
+            
+        logger.info(f"Запись {channel_name} остановлена.")
+        return True
+
+    def stop_all_recordings(self):
+        # Снимок под блокировкой: start_recording, начавшийся до shutdown, успеет зарегистрировать запись
+        with self.lock:
+            channel_names = list(self.active_recordings.keys())
+        self.stop_recordings(channel_names)
+
+    def stop_recordings(self, channel_names):
+        """Параллельная остановка записей: каждая может занять до 20 секунд"""
+        stop_threads = []
+        for name in channel_names:
+            stop_thread = threading.Thread(target=self.stop_recording, args=(name, False))
+            stop_thread.start()
+            stop_threads.append(stop_thread)
+        for stop_thread in stop_threads:
+            stop_thread.join()
+
+    def resume_recording(self, channel_name):
+        with self.lock:
+            if channel_name not in self.stopped_manually:
+                logger.warning(f"Канал {channel_name} не был остановлен вручную.")
+                return False
+            self.stopped_manually.remove(channel_name)
+        logger.info(f"Канал {channel_name} удален из списка остановленных. Запись начнется при следующей проверке.")
+        return True
+
+    def get_dir_size(self, path, exclude=()):
+        total = 0
+        try:
+            for entry in os.scandir(path):
+                if entry.is_file() and entry.name.endswith('.ts') and entry.name not in exclude:
+                    total += entry.stat().st_size
+        except OSError:
+            pass
+        return total
+
+    def get_recording_status(self, recording):
+        uptime = time.time() - recording['started_at']
+        if recording['mode'] == 'size':
+            bytes_written = recording['bytes_written']
+        else:
+            # В режиме split by time данные пишет сам ffmpeg: готовые сегменты уже учтены
+            # в bytes_written, к ним добавляем размер еще не закрытых файлов
+            completed = set(recording['completed_segments'])
+            bytes_written = recording['bytes_written'] + self.get_dir_size(recording['path'], exclude=completed)
+
+        return {
+            'running': recording['process'].poll() is None,
+            'stream_id': recording.get('stream_id'),
+            'title': recording.get('title'),
+            'path': recording['path'],
+            'started_at': datetime.datetime.fromtimestamp(recording['started_at']).isoformat(),
+            'uptime': round(uptime, 1),
+            'bytes': bytes_written,
+            'bitrate_kbps': round(bytes_written * 8 / uptime / 1000, 1) if uptime > 0 else 0
+        }
+
+    def get_status(self):
+        with self.lock:
+            recordings = dict(self.active_recordings)
+            stopped = sorted(self.stopped_manually)
+
+        first_byte_after = round(self.first_byte_at - PROCESS_START, 2) if self.first_byte_at else None
+
+        return {
+            'instance_id': self.instance_id,
+            'startup': {'first_byte_after': first_byte_after},
+            'channels': [channel['name'] for channel in self.channels if self.owns_channel(channel['name'])],
+            'recordings': {name: self.get_recording_status(rec) for name, rec in recordings.items()},
+            'stopped_manually': stopped
+        }
+
+    def find_channel(self, channel_name):
+        for channel in self.channels:
+            if channel['name'] == channel_name:
+                return channel
+        return None
+
+    def start_control_server(self):
+        host = self.settings.get('control_host', '127.0.0.1')
+        port = int(os.environ.get('RECORDER_CONTROL_PORT', self.settings.get('control_port', 8080)))
+        try:
+            self.control_server = ThreadingHTTPServer((host, port), ControlHandler)
+            self.control_server.daemon_threads = True
+            self.control_server.recorder = self
+            self.control_server.token = os.environ.get('RECORDER_CONTROL_TOKEN') or self.settings.get('control_token')
+        except Exception as e:
+            logger.error(f"Не удалось запустить API управления на {host}:{port}: {e}")
+            return
+
+        server_thread = threading.Thread(target=self.control_server.serve_forever, daemon=True)
+        server_thread.start()
+        logger.info(f"API управления запущено на http://{host}:{port}")
+        if not self.control_server.token:
+            logger.warning("Токен API управления не задан (control_token) - API доступно без авторизации")
+
+    def owns_channel(self, channel_name):
+        return not self.sharding or channel_name in self.leases
+
+    def is_assigned(self, channel_name, instance_ids):
+        # Rendezvous hashing: канал достается экземпляру с максимальным весом,
+        # при уходе экземпляра перераспределяются только его каналы
+        def weight(instance_id):
+            return hashlib.md5(f"{instance_id}:{channel_name}".encode('utf-8')).hexdigest()
+        return max(instance_ids, key=weight) == self.instance_id
+
+    def send_heartbeat(self):
+        """False - идентификатор занят другим живым процессом"""
+        now = time.time()
+        try:
+            # Запись экземпляра можно обновить, если она наша или истекла. Если ее держит
+            # другой процесс с тем же instance_id, upsert упадет на уникальном _id
+            self.instances.update_one(
+                {'_id': self.instance_id, '$or': [{'token': self.process_token}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'token': self.process_token, 'heartbeat_at': now, 'expires_at': now + self.lease_ttl}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            logger.error(f"Экземпляр с идентификатором {self.instance_id} уже запущен другим процессом. Запись не ведется.")
+            return False
+        return True
+
+    def get_live_instances(self):
+        now = time.time()
+        instance_ids = {doc['_id'] for doc in self.instances.find({'expires_at': {'$gt': now}}, {'_id': 1})}
+        instance_ids.add(self.instance_id)
+        return sorted(instance_ids)
+
+    def acquire_lease(self, channel_name):
+        """Возвращает время истечения полученной аренды или None"""
+        now = time.time()
+        try:
+            # Аренду можно взять, если она наша или истекла. Если она принадлежит
+            # другому экземпляру, upsert упадет на уникальном _id
+            self.channel_leases.update_one(
+                {'_id': channel_name, '$or': [{'owner': self.instance_id}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'owner': self.instance_id, 'expires_at': now + self.lease_ttl, 'acquired_at': now}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return None
+        return now + self.lease_ttl
+
+    def release_lease(self, channel_name):
+        with self.lock:
+            self.leases.pop(channel_name, None)
+        try:
+            self.channel_leases.delete_one({'_id': channel_name, 'owner': self.instance_id})
+            logger.info(f"Аренда канала {channel_name} освобождена.")
+        except Exception as e:
+            logger.error(f"Ошибка освобождения аренды канала {channel_name}: {e}")
+
+    def lose_leases(self, channel_names):
+        # Аренды снимаем сразу (новые записи не запустятся), а остановка записей,
+        # которая может занять до 20 секунд, идет в отдельном потоке
+        with self.lock:
+            for name in channel_names:
+                self.leases.pop(name, None)
+            recording = [name for name in channel_names if name in self.active_recordings]
+        for name in recording:
+            logger.warning(f"Аренда канала {name} потеряна. Останавливаем запись.")
+        if recording:
+            threading.Thread(target=self.stop_recordings, args=(recording,), daemon=True).start()
+
+    def check_lease_expiry(self):
+        """Сторож аренд без обращений к БД: если продление не удается (MongoDB недоступна
+        или запрос завис), останавливаем запись задолго до истечения аренды"""
+        deadline = time.time() + self.lease_ttl / 2
+        with self.lock:
+            expiring = [name for name, expires_at in self.leases.items() if expires_at <= deadline]
+        if expiring:
+            logger.warning(f"Аренды не продлены вовремя: {expiring}")
+            self.lose_leases(expiring)
+
+    def rebalance(self):
+        """Распределение каналов между экземплярами через аренды в MongoDB"""
+        if self.channel_leases is None:
+            self.setup_db()
+            if self.channel_leases is None:
+                # Без БД нельзя гарантировать единственность записи - ничего не пишем
+                self.lose_leases(list(self.leases))
+                return
+
+        if not self.send_heartbeat():
+            # Два процесса с одним идентификатором считали бы аренды друг друга своими
+            self.lose_leases(list(self.leases))
+            return
+
+        instance_ids = self.get_live_instances()
+
+        for channel in self.channels:
+            name = channel['name']
+            with self.lock:
+                recording = name in self.active_recordings
+
+            # Идущую запись не прерываем, даже если канал теперь назначен другому экземпляру:
+            # аренда освободится после окончания стрима
+            if recording or self.is_assigned(name, instance_ids):
+                expires_at = self.acquire_lease(name)
+                if expires_at:
+                    if name not in self.leases:
+                        logger.info(f"Получена аренда канала {name}.")
+                    with self.lock:
+                        self.leases[name] = expires_at
+                elif name in self.leases:
+                    self.lose_leases([name])
+            elif name in self.leases:
+                self.release_lease(name)
+
+        logger.info(f"Экземпляр {self.instance_id}: {len(self.leases)} из {len(self.channels)} каналов (активных экземпляров: {len(instance_ids)})")
+
+    def renew_leases(self):
+        """Продление аренд между проверками каналов"""
+        renew_interval = self.lease_ttl / 3
+        # Продление идет с фиксированным периодом, независимо от длительности запросов
+        next_run = time.monotonic() + renew_interval
+        while not self.shutdown_event.wait(max(0, next_run - time.monotonic())):
+            next_run += renew_interval
             try:
-                cmd_input = input()
-                parts = cmd_input.strip().split(' ', 1)
-                cmd = parts[0].lower()
-                
-                if cmd == 'stop':
-                    if len(parts) > 1:
-                        self.stop_recording(parts[1])
-                    else:
-                        logger.warning("Использование: stop <channel_name>")
-                elif cmd == 'resume':
-                    if len(parts) > 1:
-                        channel_name = parts[1]
-                        if channel_name in self.stopped_manually:
-                            self.stopped_manually.remove(channel_name)
-                            logger.info(f"Канал {channel_name} удален из списка остановленных. Запись начнется при следующей проверке.")
-                        else:
-                            logger.warning(f"Канал {channel_name} не был остановлен вручную.")
-                    else:
-                        logger.warning("Использование: resume <channel_name>")
-                elif cmd == 'list':
-                    logger.info(f"Активные записи: {list(self.active_recordings.keys())}")
-                    logger.info(f"Остановленные вручную: {list(self.stopped_manually)}")
-                elif cmd == 'quit':
-                    logger.info("Завершение работы...")
-                    for name in list(self.active_recordings.keys()):
-                        self.stop_recording(name)
-                    os._exit(0)
-            except EOFError:
-                break
+                if self.channel_leases is None:
+                    raise RuntimeError("нет подключения к MongoDB")
+
+                names = list(self.leases)
+                if names:
+                    # Локальное время истечения отсчитываем от отправки запроса
+                    sent_at = time.time()
+                    expires_at = sent_at + self.lease_ttl
+                    result = self.channel_leases.update_many(
+                        {'_id': {'$in': names}, 'owner': self.instance_id},
+                        {'$set': {'expires_at': expires_at}}
+                    )
+
+                    lost = []
+                    if result.matched_count < len(names):
+                        held = {doc['_id'] for doc in self.channel_leases.find(
+                            {'_id': {'$in': names}, 'owner': self.instance_id}, {'_id': 1}
+                        )}
+                        lost = [name for name in names if name not in held]
+
+                    with self.lock:
+                        for name in names:
+                            if name in self.leases and name not in lost:
+                                self.leases[name] = expires_at
+                    if lost:
+                        self.lose_leases(lost)
+
+                if not self.send_heartbeat():
+                    self.lose_leases(list(self.leases))
             except Exception as e:
-                logger.error(f"Ошибка при обработке команды: {e}")
+                # Истекающие аренды снимает check_lease_expiry в основном цикле
+                logger.error(f"Ошибка продления аренд: {e}")
+
+    def release_all_leases(self):
+        for name in list(self.leases):
+            self.release_lease(name)
+        try:
+            self.instances.delete_one({'_id': self.instance_id, 'token': self.process_token})
+        except Exception as e:
+            logger.error(f"Ошибка удаления экземпляра {self.instance_id}: {e}")
+
+    def save_state(self, channel_name, stream_info):
+        """Сохранение информации об идущем стриме для быстрого старта после перезапуска"""
+        if self.recorder_state is None:
+            return
+        try:
+            self.recorder_state.update_one(
+                {'_id': channel_name},
+                {'$set': {
+                    # info от yt_dlp храним строкой: в ключах могут встречаться недопустимые для MongoDB символы
+                    'stream_info': json.dumps(stream_info, ensure_ascii=False, default=str),
+                    'updated_at': datetime.datetime.now()
+                }},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Ошибка сохранения состояния канала {channel_name}: {e}")
+
+    def clear_state(self, channel_name):
+        if self.recorder_state is None:
+            return
+        try:
+            self.recorder_state.delete_one({'_id': channel_name})
+        except Exception as e:
+            logger.error(f"Ошибка удаления состояния канала {channel_name}: {e}")
+
+    def fast_start(self):
+        """Перезапуск записи каналов, которые были в эфире до остановки, без опроса yt_dlp"""
+        if self.recorder_state is None:
+            return
+
+        if self.sharding:
+            try:
+                self.rebalance()
+            except Exception as e:
+                logger.error(f"Ошибка распределения каналов: {e}")
+                return
+
+        try:
+            states = {doc['_id']: doc for doc in self.recorder_state.find()}
+        except Exception as e:
+            logger.error(f"Ошибка чтения сохраненного состояния: {e}")
+            return
 
-    def check_channels(self):
-        logger.info("Проверка каналов...")
         for channel in self.channels:
+            state = states.get(channel['name'])
+            if state is None or not self.owns_channel(channel['name']):
+                continue
             try:
-                info = self.get_stream_info(channel['url'])
-                if info:
-                    self.start_recording(channel, info)
-                else:
-                    # Если стрим не идет, но процесс висит - проверим, жив ли он
-                    if channel['name'] in self.active_recordings:
-                        obj = self.active_recordings[channel['name']]
-                        proc = None
-                        if isinstance(obj, subprocess.Popen):
-                            proc = obj
-                        elif isinstance(obj, dict):
-                            proc = obj.get('process')
-                            
-                        if proc and proc.poll() is not None:
-                            logger.info(f"Стрим {channel['name']} закончился. Процесс завершен.")
-                            del self.active_recordings[channel['name']]
+                stream_info = json.loads(state['stream_info'])
+                logger.info(f"Быстрый старт: возобновление записи {channel['name']} по сохраненному URL потока")
+                # Если URL потока устарел, ffmpeg завершится, и запись перезапустится при обычной проверке
+                self.start_recording(channel, stream_info)
             except Exception as e:
-                logger.error(f"Ошибка при проверке канала {channel['name']}: {e}")
+                logger.error(f"Ошибка быстрого старта канала {channel['name']}: {e}")
+
+    def probe_channel(self, channel):
+        info = self.get_stream_info(channel['url'], channel.get('platform'))
+        if info:
+            self.start_recording(channel, info)
+        else:
+            # Если стрим не идет, но процесс висит - проверим, жив ли он
+            with self.lock:
+                recording = self.active_recordings.get(channel['name'])
+                if recording and recording['process'].poll() is not None:
+                    logger.info(f"Стрим {channel['name']} закончился. Процесс завершен.")
+                    del self.active_recordings[channel['name']]
+                    recording = None
+            if recording is None:
+                self.clear_state(channel['name'])
+                self.enqueue_orphan_segments(channel['name'])
+        return bool(info)
+
+    def check_channels(self):
+        if not self.check_lock.acquire(blocking=False):
+            logger.info("Проверка каналов уже идет. Пропуск.")
+            return
+
+        try:
+            logger.info("Проверка каналов...")
+            # MongoDB могла быть недоступна при запуске (depends_on не ждет готовности)
+            if self.postprocess_jobs is None:
+                self.setup_db()
+            if self.postprocess_jobs is not None:
+                self.flush_pending_segments()
+
+            if self.sharding:
+                try:
+                    self.rebalance()
+                except Exception as e:
+                    logger.error(f"Ошибка распределения каналов: {e}")
+
+            for channel in self.channels:
+                if self.shutdown_event.is_set():
+                    break
+                if not self.owns_channel(channel['name']):
+                    continue
+                try:
+                    self.probe_channel(channel)
+                except Exception as e:
+                    logger.error(f"Ошибка при проверке канала {channel['name']}: {e}")
+        finally:
+            self.check_lock.release()
+
+    def start_check(self):
+        # Проверка идет в фоне: основной цикл должен оставаться свободным для сторожа аренд
+        threading.Thread(target=self.check_channels, daemon=True).start()
+
+    def shutdown(self):
+        logger.info("Завершение работы...")
+        self.shutdown_event.set()
 
     def run(self):
-        # Запуск слушателя команд в отдельном потоке
-        cmd_thread = threading.Thread(target=self.command_listener, daemon=True)
-        cmd_thread.start()
+        # Запуск API управления в отдельном потоке
+        self.start_control_server()
+
+        if self.sharding:
+            logger.info(f"Шардинг включен, экземпляр: {self.instance_id}")
+            threading.Thread(target=self.renew_leases, daemon=True).start()
+
+        # Сначала возобновляем записи, которые шли до перезапуска
+        self.fast_start()
 
         interval = self.settings.get('check_interval', 60)
-        schedule.every(interval).seconds.do(self.check_channels)
+        schedule.every(interval).seconds.do(self.start_check)
         
-        # Первая проверка сразу
-        self.check_channels()
+        # Первая проверка сразу, но в фоне - не задерживает основной цикл
+        self.start_check()
         
-        while True:
+        while not self.shutdown_event.is_set():
+            if self.sharding:
+                self.check_lease_expiry()
             schedule.run_pending()
-            time.sleep(1)
+            self.shutdown_event.wait(1)
+
+        # Корректное завершение: останавливаем все записи, дописывая текущие сегменты
+        self.stop_all_recordings()
+        if self.sharding:
+            # Освобождаем аренды сразу, чтобы другие экземпляры не ждали их истечения
+            self.release_all_leases()
+        if self.control_server is not None:
+            self.control_server.shutdown()
+        logger.info("Рекордер остановлен.")
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """HTTP API управления рекордером.
+
+    GET  /status                   - состояние всех записей
+    GET  /channels/<name>          - состояние записи канала
+    POST /channels/<name>/stop     - остановить запись канала
+    POST /channels/<name>/resume   - разрешить запись канала снова
+    POST /channels/<name>/probe    - немедленно проверить канал
+    POST /probe                    - немедленно проверить все каналы (в фоне)
+    POST /shutdown                 - корректно завершить работу
+
+    Если задан control_token, запросы должны содержать заголовок
+    Authorization: Bearer <token>.
+    """
+
+    def check_auth(self):
+        token = self.server.token
+        if not token:
+            return True
+        header = self.headers.get('Authorization', '')
+        if hmac.compare_digest(header.encode('utf-8'), f"Bearer {token}".encode('utf-8')):
+            return True
+        self.send_json(401, {'error': 'Unauthorized'})
+        return False
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse_path(self):
+        path = self.path.split('?', 1)[0]
+        return [unquote(part) for part in path.strip('/').split('/') if part]
+
+    def do_GET(self):
+        if not self.check_auth():
+            return
+        recorder = self.server.recorder
+        parts = self.parse_path()
+        try:
+            if parts == ['status']:
+                self.send_json(200, recorder.get_status())
+            elif len(parts) == 2 and parts[0] == 'channels':
+                with recorder.lock:
+                    recording = recorder.active_recordings.get(parts[1])
+                if recording is None:
+                    self.send_json(404, {'error': f"Канал {parts[1]} сейчас не записывается"})
+                else:
+                    self.send_json(200, recorder.get_recording_status(recording))
+            else:
+                self.send_json(404, {'error': 'Not found'})
+        except Exception as e:
+            logger.error(f"Ошибка при обработке запроса API {self.path}: {e}")
+            self.send_json(500, {'error': str(e)})
+
+    def do_POST(self):
+        if not self.check_auth():
+            return
+        recorder = self.server.recorder
+        parts = self.parse_path()
+        try:
+            if parts == ['probe']:
+                recorder.start_check()
+                self.send_json(202, {'status': 'probing'})
+            elif parts == ['shutdown']:
+                recorder.shutdown()
+                self.send_json(202, {'status': 'shutting_down'})
+            elif len(parts) == 3 and parts[0] == 'channels':
+                channel_name, action = parts[1], parts[2]
+                if action == 'stop':
+                    ok = recorder.stop_recording(channel_name)
+                    self.send_json(200 if ok else 409, {'channel': channel_name, 'stopped': ok})
+                elif action == 'resume':
+                    ok = recorder.resume_recording(channel_name)
+                    self.send_json(200 if ok else 409, {'channel': channel_name, 'resumed': ok})
+                elif action == 'probe':
+                    channel = recorder.find_channel(channel_name)
+                    if channel is None:
+                        self.send_json(404, {'error': f"Канал {channel_name} не найден в конфигурации"})
+                        return
+                    if not recorder.owns_channel(channel_name):
+                        self.send_json(409, {'error': f"Канал {channel_name} обслуживается другим экземпляром"})
+                        return
+                    live = recorder.probe_channel(channel)
+                    with recorder.lock:
+                        recording = channel_name in recorder.active_recordings
+                    self.send_json(200, {'channel': channel_name, 'live': live, 'recording': recording})
+                else:
+                    self.send_json(404, {'error': 'Not found'})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+        except Exception as e:
+            logger.error(f"Ошибка при обработке запроса API {self.path}: {e}")
+            self.send_json(500, {'error': str(e)})
+
+    def log_message(self, format, *args):
+        logger.debug(f"API: {format % args}")
 
 if __name__ == "__main__":
     recorder = StreamRecorder()
+    # docker stop отправляет SIGTERM - завершаем работу корректно
+    signal.signal(signal.SIGTERM, lambda signum, frame: recorder.shutdown())
     try:
         recorder.run()
     except KeyboardInterrupt:
         logger.info("Остановка скрипта...")
+        recorder.shutdown()
+        recorder.stop_all_recordings()